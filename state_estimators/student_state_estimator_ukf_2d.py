@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
+
 # ROS imports
 import rospy
 from sensor_msgs.msg import Imu, Range
+from std_msgs.msg import Header
 from pidrone_pkg.msg import State
 
 # UKF imports
@@ -18,7 +21,30 @@ from filterpy.kalman import MerweScaledSigmaPoints
 # Other imports
 import numpy as np
 import argparse
+import collections
 import os
+import struct
+
+
+# ema_state_callback reads the EMA filter's State messages without
+# deserializing them, which relies on the layout of pidrone_pkg's State message,
+# so check that layout rather than silently reading the wrong bytes
+if (Header._slot_types != ['uint32', 'time', 'string'] or
+        State._slot_types != ['std_msgs/Header',
+                              'geometry_msgs/PoseWithCovariance',
+                              'geometry_msgs/TwistWithCovariance']):
+    raise RuntimeError('Unexpected State message layout: {}'.format(
+        State._slot_types))
+
+# Snapshot of a state estimate from the UKF, stored in latest_estimate:
+#   secs, nsecs : timestamp of the input that produced the estimate
+#   x : copy of the state vector [z, z_vel]
+#   P : copy of the state covariance matrix, or None if covariance publishing
+#       is turned off
+# Position and velocity along x and y are not part of it; they come from the
+# EMA filter, via latest_ema_xy.
+StateEstimate = collections.namedtuple('StateEstimate',
+                                       ['secs', 'nsecs', 'x', 'P'])
 
 
 class UKFStateEstimator2D(object):
@@ -32,10 +58,23 @@ class UKFStateEstimator2D(object):
     state variables in the state vector: z position and z velocity.
     """
     
-    def __init__(self, loop_hz, ir_throttled=False, imu_throttled=False):
+    # Layout of a serialized State message, used to read x and y position and
+    # velocity from the EMA filter without deserializing the whole message.
+    # The header ends with frame_id, a uint32 length after seq and stamp
+    # (three uint32) followed by that many bytes. pose.position comes right
+    # after the header, and twist.linear follows the rest of the pose (3
+    # position and 4 orientation float64) and its 36 float64 covariance.
+    ema_frame_id_len_offset = 12
+    ema_linear_offset = (7 + 36)*8
+    uint32_struct = struct.Struct('<I')
+    xy_struct = struct.Struct('<2d')
+    
+    def __init__(self, loop_hz, ir_throttled=False, imu_throttled=False,
+                 publish_rate=50.0, publish_covariance=True):
         self.loop_hz = loop_hz
         self.ir_topic_str = '/pidrone/infrared'
         self.imu_topic_str = '/pidrone/imu'
+        self.ema_topic_str = '/pidrone/state/ema'
         throttle_suffix = '_throttle'
         
         if ir_throttled:
@@ -55,6 +94,27 @@ class UKFStateEstimator2D(object):
         # when the inputs come in
         self.dt = None
         
+        # Simple downstream controllers ignore covariances, so filling them in
+        # can be turned off, in which case they are left as NaN (unknown)
+        self.publish_covariance = publish_covariance
+        self.initialize_state_msg()
+        
+        # The most recent (x, y, x_vel, y_vel) tuple from the EMA filter
+        self.latest_ema_xy = None
+        
+        # Snapshot of the most recent state estimate, handed from the sensor
+        # callbacks to the publish timer as a single reference so that neither
+        # side needs a lock. The timer logs errors while publishing rather than
+        # raising them, as rospy does not catch them and the timer thread would
+        # die. A host process can read the snapshot the same way, without
+        # subscribing to our topic; a new StateEstimate means a new estimate.
+        # Downstream consumers do not need state estimates faster than
+        # publish_rate, so the timer runs at that rate.
+        self.latest_estimate = None
+        self.last_published_estimate = None
+        self.last_published_ema_xy = None
+        self.publish_period = rospy.Duration(1.0/publish_rate)
+        
         # Initialize the last control input as 0 m/s^2 along the z-axis
         self.last_control_input = np.array([0.0])
         
@@ -65,17 +125,35 @@ class UKFStateEstimator2D(object):
         Initialize ROS-related objects, e.g., the node, subscribers, etc.
         """
         self.node_name = os.path.splitext(os.path.basename(__file__))[0]
-        print 'Initializing {} node...'.format(self.node_name)
-        rospy.init_node(self.node_name)
+        # Only create a node if we are not being hosted in-process by another
+        # node (e.g., the top-level state estimator), in which case we share
+        # its node and can read self.latest_estimate directly
+        if not rospy.core.is_initialized():
+            print('Initializing {} node...'.format(self.node_name))
+            rospy.init_node(self.node_name)
         
         # Subscribe to topics to which the drone publishes in order to get raw
         # data from sensors, which we can then filter
-        rospy.Subscriber(self.imu_topic_str, Imu, self.imu_data_callback)
-        rospy.Subscriber(self.ir_topic_str, Range, self.ir_data_callback)
+        # Only the latest message is of interest, and a large buff_size keeps
+        # rospy's receive buffer from backing up and delivering stale data
+        rospy.Subscriber(self.imu_topic_str, Imu, self.imu_data_callback,
+                         queue_size=1, tcp_nodelay=True, buff_size=2**20)
+        rospy.Subscriber(self.ir_topic_str, Range, self.ir_data_callback,
+                         queue_size=1, tcp_nodelay=True, buff_size=2**20)
+        
+        # Subscribe to the EMA filter's state estimates in order to fill in the
+        # x and y components that this UKF does not track. Subscribe with
+        # AnyMsg, since we only need four floats out of the message.
+        rospy.Subscriber(self.ema_topic_str, rospy.AnyMsg, self.ema_state_callback,
+                         queue_size=1, tcp_nodelay=True, buff_size=2**20)
         
         # Create the publisher to publish state estimates
         self.state_pub = rospy.Publisher('/pidrone/state/ukf_2d', State, queue_size=1,
-                                         tcp_nodelay=False)
+                                         tcp_nodelay=True)
+        
+        # Publish state estimates on a timer, decoupled from the sensor
+        # callbacks
+        rospy.Timer(self.publish_period, self.publish_state_tick)
         
     def initialize_ukf(self):
         """
@@ -130,6 +208,36 @@ class UKFStateEstimator2D(object):
         #       static setup
         # self.ukf.R = np.array([?])
         
+    def initialize_state_msg(self):
+        """
+        Initialize the State message that publish_state_tick reuses. The
+        fields that the 2D UKF does not track are filled with NaN once here,
+        rather than on every publish. Reusing the message is safe because only
+        the publish timer touches it, and rospy serializes it synchronously in
+        publish().
+        """
+        self.state_msg = State()
+        self.state_msg.header.frame_id = 'global'
+        
+        # Fill the fields that we do not track with NaN. Position and velocity
+        # along x and y get overwritten once the EMA filter publishes.
+        self.state_msg.pose_with_covariance.pose.position.x = np.nan
+        self.state_msg.pose_with_covariance.pose.position.y = np.nan
+        self.state_msg.pose_with_covariance.pose.orientation.x = np.nan
+        self.state_msg.pose_with_covariance.pose.orientation.y = np.nan
+        self.state_msg.pose_with_covariance.pose.orientation.z = np.nan
+        self.state_msg.pose_with_covariance.pose.orientation.w = np.nan
+        self.state_msg.twist_with_covariance.twist.linear.x = np.nan
+        self.state_msg.twist_with_covariance.twist.linear.y = np.nan
+        self.state_msg.twist_with_covariance.twist.angular.x = np.nan
+        self.state_msg.twist_with_covariance.twist.angular.y = np.nan
+        self.state_msg.twist_with_covariance.twist.angular.z = np.nan
+        
+        # Prepare covariance matrices
+        # 36-element array, in a row-major order, according to ROS msg docs
+        self.state_msg.pose_with_covariance.covariance = np.full((36,), np.nan)
+        self.state_msg.twist_with_covariance.covariance = np.full((36,), np.nan)
+        
     def initialize_input_time(self, msg):
         """
         Initialize the input time (self.last_state_transition_time) based on the
@@ -177,49 +285,92 @@ class UKFStateEstimator2D(object):
         ##########################################
         self.in_callback = False
                         
+    def ema_state_callback(self, msg):
+        """
+        Handle the receipt of a serialized State message from the EMA filter.
+        Only unpack the position and velocity along the x- and y-axes, which
+        get published as part of our own state estimate.
+        
+        msg : a rospy.AnyMsg wrapping a serialized State message
+        """
+        buff = msg._buff
+        frame_id_len, = self.uint32_struct.unpack_from(
+            buff, self.ema_frame_id_len_offset)
+        header_end = self.ema_frame_id_len_offset + 4 + frame_id_len
+        x, y = self.xy_struct.unpack_from(buff, header_end)
+        x_vel, y_vel = self.xy_struct.unpack_from(
+            buff, header_end + self.ema_linear_offset)
+        self.latest_ema_xy = (x, y, x_vel, y_vel)
+                        
     def publish_current_state(self):
         """
-        Publish the current state estimate and covariance from the UKF. This is
-        a State message containing:
+        Call this from the sensor callbacks after each prediction or update.
+        Despite its name, this method does not publish: it stores a snapshot of
+        the current state estimate and covariance from the UKF in
+        self.latest_estimate, and publish_state_tick builds and publishes the
+        State message from that snapshot at publish_rate.
+        """
+        self.latest_estimate = StateEstimate(
+            secs=self.last_time_secs, nsecs=self.last_time_nsecs,
+            x=self.ukf.x.copy(),
+            P=self.ukf.P.copy() if self.publish_covariance else None)
+        
+    def publish_state_tick(self, event):
+        """
+        Timer callback that publishes the most recent state estimate. rospy
+        does not catch exceptions raised in a timer callback, and one would
+        end the timer thread and stop all further publishing, so log errors
+        here and carry on with the next tick instead.
+        
+        event : a rospy.TimerEvent
+        """
+        try:
+            self.publish_latest_estimate()
+        except Exception as e:
+            rospy.logerr_throttle(1.0, 'Failed to publish state estimate: '
+                                  '{}'.format(e))
+        
+    def publish_latest_estimate(self):
+        """
+        Publish the most recent state estimate, if either it or the most recent
+        EMA estimate has not been published yet. This is a State message
+        containing:
             - Header
             - PoseWithCovariance
             - TwistWithCovariance
         Note that a lot of these ROS message fields will be left empty, as the
         2D UKF does not track information on the entire state space of the
-        drone.
+        drone. Position and velocity along x and y come from the EMA filter, so
+        they stay fresh even if the IR stream stalls; the header stamp is that
+        of the most recent UKF estimate.
         """
-        state_msg = State()
-        state_msg.header.stamp.secs = self.last_time_secs
-        state_msg.header.stamp.nsecs = self.last_time_nsecs
-        state_msg.header.frame_id = 'global'
-        
-        # Get the current state estimate from self.ukf.x
-        state_msg.pose_with_covariance.pose.position.z = self.ukf.x[0]
-        state_msg.twist_with_covariance.twist.linear.z = self.ukf.x[1]
-        
-        # Fill the rest of the message with NaN
-        state_msg.pose_with_covariance.pose.position.x = np.nan
-        state_msg.pose_with_covariance.pose.position.y = np.nan
-        state_msg.pose_with_covariance.pose.orientation.x = np.nan
-        state_msg.pose_with_covariance.pose.orientation.y = np.nan
-        state_msg.pose_with_covariance.pose.orientation.z = np.nan
-        state_msg.pose_with_covariance.pose.orientation.w = np.nan
-        state_msg.twist_with_covariance.twist.linear.x = np.nan
-        state_msg.twist_with_covariance.twist.linear.y = np.nan
-        state_msg.twist_with_covariance.twist.angular.x = np.nan
-        state_msg.twist_with_covariance.twist.angular.y = np.nan
-        state_msg.twist_with_covariance.twist.angular.z = np.nan
+        estimate = self.latest_estimate
+        ema_xy = self.latest_ema_xy
+        if estimate is None or (estimate is self.last_published_estimate and
+                                ema_xy is self.last_published_ema_xy):
+            return
+        self.last_published_estimate = estimate
+        self.last_published_ema_xy = ema_xy
+        secs, nsecs, x, P = estimate
         
-        # Prepare covariance matrices
-        # 36-element array, in a row-major order, according to ROS msg docs
-        pose_cov_mat = np.full((36,), np.nan)
-        twist_cov_mat = np.full((36,), np.nan)
-        pose_cov_mat[14] = self.ukf.P[0, 0]  # z variance
-        twist_cov_mat[14] = self.ukf.P[1, 1]  # z velocity variance
+        state_msg = self.state_msg
+        state_msg.header.stamp.secs = secs
+        state_msg.header.stamp.nsecs = nsecs
+        position = state_msg.pose_with_covariance.pose.position
+        linear = state_msg.twist_with_covariance.twist.linear
         
-        # Add covariances to message
-        state_msg.pose_with_covariance.covariance = pose_cov_mat
-        state_msg.twist_with_covariance.covariance = twist_cov_mat
+        # Get the current state estimate from the snapshot of self.ukf.x
+        position.z = x[0]
+        linear.z = x[1]
+        
+        # Take position and velocity along x and y from the EMA filter
+        if ema_xy is not None:
+            position.x, position.y, linear.x, linear.y = ema_xy
+        
+        # Update the covariances that we track in place
+        if self.publish_covariance:
+            state_msg.pose_with_covariance.covariance[14] = P[0, 0]  # z variance
+            state_msg.twist_with_covariance.covariance[14] = P[1, 1]  # z velocity variance
         
         self.state_pub.publish(state_msg)
 
@@ -256,12 +407,12 @@ class UKFStateEstimator2D(object):
         
 def check_positive_float_duration(val):
     """
-    Function to check that the --loop_hz command-line argument is a positive
-    float.
+    Function to check that a rate command-line argument (--loop_hz or
+    --publish_rate) is a positive float.
     """
     value = float(val)
     if value <= 0.0:
-        raise argparse.ArgumentTypeError('Loop Hz must be positive')
+        raise argparse.ArgumentTypeError('Rate must be positive')
     return value
         
 def main():
@@ -277,18 +428,27 @@ def main():
                         type=check_positive_float_duration,
                         help=('Frequency at which to run the predict-update '
                               'loop of the UKF (default: 30)'))
+    parser.add_argument('--publish_rate', default=50.0,
+                        type=check_positive_float_duration,
+                        help=('Maximum frequency at which to publish state '
+                              'estimates (default: 50)'))
+    parser.add_argument('--no_publish_covariance', dest='publish_covariance',
+                        action='store_false',
+                        help=('Do not fill in the covariances of published '
+                              'state estimates; leave them as NaN'))
     args = parser.parse_args()
     se = UKFStateEstimator2D(loop_hz=args.loop_hz,
                              ir_throttled=args.ir_throttled,
-                             imu_throttled=args.imu_throttled)
+                             imu_throttled=args.imu_throttled,
+                             publish_rate=args.publish_rate,
+                             publish_covariance=args.publish_covariance)
     try:
         # Wait until node is halted
         rospy.spin()
     finally:
-        # Upon termination of this script, print out a helpful message
-        print '{} node terminating.'.format(se.node_name)
-        print 'Most recent state vector:'
-        print se.ukf.x
+        # Upon termination of this script, log the final state via rospy
+        rospy.loginfo('%s node terminating.', se.node_name)
+        rospy.loginfo('Most recent state vector: %s', se.ukf.x)
         
 if __name__ == '__main__':
     main()
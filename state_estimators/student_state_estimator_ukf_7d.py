@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
+
 # ROS imports
 import rospy
 import tf
@@ -20,9 +22,23 @@ from filterpy.kalman import MerweScaledSigmaPoints
 # Other imports
 import numpy as np
 import argparse
+import collections
 import os
 
 
+# Snapshot of a state estimate from the UKF, stored in latest_estimate:
+#   secs, nsecs : timestamp of the input that produced the estimate
+#   x : copy of the state vector [x, y, z, x_vel, y_vel, z_vel, yaw]
+#   P : copy of the state covariance matrix, or None if covariance publishing
+#       is turned off
+#   quaternion : orientation [x, y, z, w] from IMU roll and pitch and UKF yaw
+#   angular_velocity : most recent angular velocity from the IMU, or None if
+#                      the IMU has not published yet
+StateEstimate = collections.namedtuple('StateEstimate',
+                                       ['secs', 'nsecs', 'x', 'P', 'quaternion',
+                                        'angular_velocity'])
+
+
 class UKFStateEstimator7D(object):
     """
     Class that estimates the state of the drone using an Unscented Kalman Filter
@@ -30,7 +46,7 @@ class UKFStateEstimator7D(object):
     estimate aspects of the drone's pose and twist in three-dimensional space.
     """
     
-    def __init__(self, loop_hz, ir_throttled=False, imu_throttled=False, optical_flow_throttled=False, camera_pose_throttled=False):
+    def __init__(self, loop_hz, ir_throttled=False, imu_throttled=False, optical_flow_throttled=False, camera_pose_throttled=False, publish_rate=50.0, publish_covariance=True):
         self.loop_hz = loop_hz
         self.ir_topic_str = '/pidrone/infrared'
         self.imu_topic_str = '/pidrone/imu'
@@ -63,6 +79,23 @@ class UKFStateEstimator7D(object):
         # when the inputs come in
         self.dt = None
         
+        # Simple downstream controllers ignore covariances, so filling them in
+        # can be turned off, in which case they are left as NaN (unknown)
+        self.publish_covariance = publish_covariance
+        self.initialize_state_msg()
+        
+        # Snapshot of the most recent state estimate, handed from the sensor
+        # callbacks to the publish timer as a single reference so that neither
+        # side needs a lock. The timer logs errors while publishing rather than
+        # raising them, as rospy does not catch them and the timer thread would
+        # die. A host process can read the snapshot the same way, without
+        # subscribing to our topic; a new StateEstimate means a new estimate.
+        # Downstream consumers do not need state estimates faster than
+        # publish_rate, so the timer runs at that rate.
+        self.latest_estimate = None
+        self.last_published_estimate = None
+        self.publish_period = rospy.Duration(1.0/publish_rate)
+        
         # Initialize the last control input as 0 m/s^2 along each axis
         self.last_control_input = np.array([0.0, 0.0, 0.0])
         
@@ -73,21 +106,35 @@ class UKFStateEstimator7D(object):
         Initialize ROS-related objects, e.g., the node, subscribers, etc.
         """
         self.node_name = os.path.splitext(os.path.basename(__file__))[0]
-        print 'Initializing {} node...'.format(self.node_name)
-        rospy.init_node(self.node_name)
+        # Only create a node if we are not being hosted in-process by another
+        # node (e.g., the top-level state estimator), in which case we share
+        # its node and can read self.latest_estimate directly
+        if not rospy.core.is_initialized():
+            print('Initializing {} node...'.format(self.node_name))
+            rospy.init_node(self.node_name)
         
         # Create the publisher to publish state estimates
         self.state_pub = rospy.Publisher('/pidrone/state/ukf_7d', State, queue_size=1,
-                                         tcp_nodelay=False)
+                                         tcp_nodelay=True)
+        
+        # Publish state estimates on a timer, decoupled from the sensor
+        # callbacks
+        rospy.Timer(self.publish_period, self.publish_state_tick)
         
         # Subscribe to topics to which the drone publishes in order to get raw
         # data from sensors, which we can then filter
-        rospy.Subscriber(self.imu_topic_str, Imu, self.imu_data_callback)
-        rospy.Subscriber(self.ir_topic_str, Range, self.ir_data_callback)
+        # Only the latest message is of interest, and a large buff_size keeps
+        # rospy's receive buffer from backing up and delivering stale data
+        rospy.Subscriber(self.imu_topic_str, Imu, self.imu_data_callback,
+                         queue_size=1, tcp_nodelay=True, buff_size=2**20)
+        rospy.Subscriber(self.ir_topic_str, Range, self.ir_data_callback,
+                         queue_size=1, tcp_nodelay=True, buff_size=2**20)
         rospy.Subscriber(self.optical_flow_topic_str, TwistStamped,
-                         self.optical_flow_data_callback)
+                         self.optical_flow_data_callback,
+                         queue_size=1, tcp_nodelay=True, buff_size=2**20)
         rospy.Subscriber(self.camera_pose_topic_str, PoseStamped,
-                         self.camera_pose_data_callback)
+                         self.camera_pose_data_callback,
+                         queue_size=1, tcp_nodelay=True, buff_size=2**20)
         
     def initialize_ukf(self):
         """
@@ -154,6 +201,21 @@ class UKFStateEstimator7D(object):
         #       (i.e., the diagionals of the matrix).
         # self.ukf.R = ?
         
+    def initialize_state_msg(self):
+        """
+        Initialize the State message that publish_state_tick reuses, so that a
+        new message and covariance arrays are not allocated on every publish.
+        Reusing the message is safe because only the publish timer touches it,
+        and rospy serializes it synchronously in publish().
+        """
+        self.state_msg = State()
+        self.state_msg.header.frame_id = 'global'
+        
+        # Prepare covariance matrices
+        # 36-element array, in a row-major order, according to ROS msg docs
+        self.state_msg.pose_with_covariance.covariance = np.full((36,), np.nan)
+        self.state_msg.twist_with_covariance.covariance = np.full((36,), np.nan)
+        
     def initialize_input_time(self, msg):
         """
         Initialize the input time (self.last_state_transition_time) based on the
@@ -247,17 +309,12 @@ class UKFStateEstimator7D(object):
                         
     def publish_current_state(self):
         """
-        Publish the current state estimate and covariance from the UKF. This is
-        a State message containing:
-            - Header
-            - PoseWithCovariance
-            - TwistWithCovariance
+        Call this from the sensor callbacks after each prediction or update.
+        Despite its name, this method does not publish: it stores a snapshot of
+        the current state estimate and covariance from the UKF in
+        self.latest_estimate, and publish_state_tick builds and publishes the
+        State message from that snapshot at publish_rate.
         """
-        state_msg = State()
-        state_msg.header.stamp.secs = self.last_time_secs
-        state_msg.header.stamp.nsecs = self.last_time_nsecs
-        state_msg.header.frame_id = 'global'
-        
         # TODO:
         # Convert RPY Euler angles (radians) to a quaternion, using the yaw
         # estimate from the UKF (informed by measurements from
@@ -265,29 +322,66 @@ class UKFStateEstimator7D(object):
         # the IMU, as the IMU implements its own filter on attitude
         # quaternion = tf.transformations.quaternion_from_euler(?, ?, ?)
         
-        # Get the current state estimate from self.ukf.x
-        state_msg.pose_with_covariance.pose.position.x = self.ukf.x[0]
-        state_msg.pose_with_covariance.pose.position.y = self.ukf.x[1]
-        state_msg.pose_with_covariance.pose.position.z = self.ukf.x[2]
+        self.latest_estimate = StateEstimate(
+            secs=self.last_time_secs, nsecs=self.last_time_nsecs,
+            x=self.ukf.x.copy(),
+            P=self.ukf.P.copy() if self.publish_covariance else None,
+            quaternion=quaternion, angular_velocity=self.angular_velocity)
+        
+    def publish_state_tick(self, event):
+        """
+        Timer callback that publishes the most recent state estimate. rospy
+        does not catch exceptions raised in a timer callback, and one would
+        end the timer thread and stop all further publishing, so log errors
+        here and carry on with the next tick instead.
+        
+        event : a rospy.TimerEvent
+        """
+        try:
+            self.publish_latest_estimate()
+        except Exception as e:
+            rospy.logerr_throttle(1.0, 'Failed to publish state estimate: '
+                                  '{}'.format(e))
+        
+    def publish_latest_estimate(self):
+        """
+        Publish the most recent state estimate, if it has not been published
+        yet. This is a State message containing:
+            - Header
+            - PoseWithCovariance
+            - TwistWithCovariance
+        """
+        estimate = self.latest_estimate
+        if estimate is None or estimate is self.last_published_estimate:
+            return
+        secs, nsecs, x, P, quaternion, angular_velocity = estimate
+        # The State message needs angular velocity, which we only have once the
+        # IMU has published
+        if angular_velocity is None:
+            return
+        self.last_published_estimate = estimate
+        
+        state_msg = self.state_msg
+        state_msg.header.stamp.secs = secs
+        state_msg.header.stamp.nsecs = nsecs
+        
+        # Get the current state estimate from the snapshot of self.ukf.x
+        state_msg.pose_with_covariance.pose.position.x = x[0]
+        state_msg.pose_with_covariance.pose.position.y = x[1]
+        state_msg.pose_with_covariance.pose.position.z = x[2]
         state_msg.pose_with_covariance.pose.orientation.x = quaternion[0]
         state_msg.pose_with_covariance.pose.orientation.y = quaternion[1]
         state_msg.pose_with_covariance.pose.orientation.z = quaternion[2]
         state_msg.pose_with_covariance.pose.orientation.w = quaternion[3]
-        state_msg.twist_with_covariance.twist.linear.x = self.ukf.x[3]
-        state_msg.twist_with_covariance.twist.linear.y = self.ukf.x[4]
-        state_msg.twist_with_covariance.twist.linear.z = self.ukf.x[5]
-        state_msg.twist_with_covariance.twist.angular = self.angular_velocity
+        state_msg.twist_with_covariance.twist.linear.x = x[3]
+        state_msg.twist_with_covariance.twist.linear.y = x[4]
+        state_msg.twist_with_covariance.twist.linear.z = x[5]
+        state_msg.twist_with_covariance.twist.angular = angular_velocity
         
-        # Prepare covariance matrices
-        # 36-element array, in a row-major order, according to ROS msg docs
-        pose_cov_mat = np.full((36,), np.nan)
-        twist_cov_mat = np.full((36,), np.nan)
-        pose_cov_mat[14] = self.ukf.P[2, 2] # z variance
-        twist_cov_mat[14] = self.ukf.P[5, 5] # z velocity variance
-        
-        # Add covariances to message
-        state_msg.pose_with_covariance.covariance = pose_cov_mat
-        state_msg.twist_with_covariance.covariance = twist_cov_mat
+        # Update the covariances that we track in place
+        if self.publish_covariance:
+            state_msg.pose_with_covariance.covariance[14] = P[2, 2] # z variance
+            state_msg.twist_with_covariance.covariance[14] = P[5, 5] # z velocity variance
         
         self.state_pub.publish(state_msg)
         
@@ -356,12 +450,12 @@ class UKFStateEstimator7D(object):
         
 def check_positive_float_duration(val):
     """
-    Function to check that the --loop_hz command-line argument is a positive
-    float.
+    Function to check that a rate command-line argument (--loop_hz or
+    --publish_rate) is a positive float.
     """
     value = float(val)
     if value <= 0.0:
-        raise argparse.ArgumentTypeError('Loop Hz must be positive')
+        raise argparse.ArgumentTypeError('Rate must be positive')
     return value
         
 def main():
@@ -382,20 +476,29 @@ def main():
                         type=check_positive_float_duration,
                         help=('Frequency at which to run the predict-update '
                               'loop of the UKF (default: 30)'))
+    parser.add_argument('--publish_rate', default=50.0,
+                        type=check_positive_float_duration,
+                        help=('Maximum frequency at which to publish state '
+                              'estimates (default: 50)'))
+    parser.add_argument('--no_publish_covariance', dest='publish_covariance',
+                        action='store_false',
+                        help=('Do not fill in the covariances of published '
+                              'state estimates; leave them as NaN'))
     args = parser.parse_args()
     se = UKFStateEstimator7D(loop_hz=args.loop_hz,
                              ir_throttled=args.ir_throttled,
                              imu_throttled=args.imu_throttled,
                              optical_flow_throttled=args.optical_flow_throttled,
-                             camera_pose_throttled=args.camera_pose_throttled)
+                             camera_pose_throttled=args.camera_pose_throttled,
+                             publish_rate=args.publish_rate,
+                             publish_covariance=args.publish_covariance)
     try:
         # Wait until node is halted
         rospy.spin()
     finally:
-        # Upon termination of this script, print out a helpful message
-        print '{} node terminating.'.format(se.node_name)
-        print 'Most recent state vector:'
-        print se.ukf.x
+        # Upon termination of this script, log the final state via rospy
+        rospy.loginfo('%s node terminating.', se.node_name)
+        rospy.loginfo('Most recent state vector: %s', se.ukf.x)
         
 if __name__ == '__main__':
     main()